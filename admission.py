@@ -0,0 +1,169 @@
+import os
+import time
+import random
+import fcntl
+import sqlite3
+import tempfile
+import threading
+from functools import wraps
+
+from flask import request, jsonify
+
+
+class TokenBucketStore:
+    """Token buckets kept in a local SQLite file so every gunicorn worker on the host shares them"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, keys, cost, rate, burst):
+        """Spend cost tokens from every key's bucket, or from none of them
+
+        Returns (allowed, seconds until every bucket has refilled enough). All
+        buckets are read and written in one transaction, so a request rejected
+        by one bucket never drains another.
+        """
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            levels = {}
+            for key in keys:
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                levels[key] = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            allowed = all(tokens >= cost for tokens in levels.values())
+            conn.executemany(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                [(key, tokens - cost if allowed else tokens, now) for key, tokens in levels.items()]
+            )
+            if random.random() < 0.01:
+                # A bucket idle long enough to refill completely is the same as no row at all
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - burst / rate,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if allowed:
+            return True, 0.0
+        return False, max((cost - tokens) / rate for tokens in levels.values())
+
+
+class InflightLimiter:
+    """Host-wide cap on concurrent inferences using one flock()ed slot file per permit
+
+    The kernel drops a dead worker's locks, so a crashed process can't leak permits.
+    """
+
+    def __init__(self, directory, slots):
+        self.directory = directory
+        self.slots = slots
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self):
+        """Return a held slot file descriptor, or None when every slot is busy"""
+        for slot in range(self.slots):
+            fd = os.open(os.path.join(self.directory, f'slot_{slot}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def configure(app):
+    """Read admission-control settings from the environment into app.config"""
+    state_dir = os.environ.get('ADMISSION_STATE_DIR', os.path.join(tempfile.gettempdir(), 'flask_moosic_admission'))
+    os.makedirs(state_dir, exist_ok=True)
+
+    app.config['RATE_LIMIT_PER_MINUTE'] = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+    app.config['RATE_LIMIT_BURST'] = float(os.environ.get('RATE_LIMIT_BURST', 10))
+    app.config['MAX_INFLIGHT_INFERENCES'] = int(os.environ.get('MAX_INFLIGHT_INFERENCES', os.cpu_count() or 1))
+    app.config['MAX_IMAGE_CHARS'] = int(os.environ.get('MAX_IMAGE_CHARS', 2 * 1024 * 1024))
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+    # A batch costs one token per image, so anything larger than the burst could never be admitted
+    burst_images = int(app.config['RATE_LIMIT_BURST'])
+    if app.config.get('MAX_BATCH_SIZE', burst_images) > burst_images:
+        print(f"⚠️  MAX_BATCH_SIZE lowered to RATE_LIMIT_BURST ({burst_images})")
+        app.config['MAX_BATCH_SIZE'] = burst_images
+
+    app.extensions['admission'] = {
+        'buckets': TokenBucketStore(os.path.join(state_dir, 'buckets.db')),
+        'inflight': InflightLimiter(os.path.join(state_dir, 'inflight'), app.config['MAX_INFLIGHT_INFERENCES'])
+    }
+
+
+def client_keys():
+    """Rate-limit keys for this request: always the client IP, plus the client token if one is sent"""
+    keys = [f'ip:{request.remote_addr}']
+    token = request.headers.get('X-Client-Token')
+    if token:
+        keys.append(f'token:{token[:128]}')
+    return keys
+
+
+def too_many(message, status, retry_after):
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
+def admission_controlled(app, cost=lambda: 1, max_body=None):
+    """Reject oversized, over-rate or over-capacity inference requests before any image is decoded
+
+    max_body optionally returns a tighter per-route byte limit than MAX_CONTENT_LENGTH.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            limit = min(app.config['MAX_CONTENT_LENGTH'], max_body()) if max_body else app.config['MAX_CONTENT_LENGTH']
+            if request.content_length and request.content_length > limit:
+                return jsonify({'error': 'request body too large'}), 413
+
+            state = app.extensions['admission']
+            rate = app.config['RATE_LIMIT_PER_MINUTE'] / 60.0
+            burst = app.config['RATE_LIMIT_BURST']
+            keys = client_keys()
+            try:
+                # Spend one token before cost() reads the body, so an over-limit client gets a cheap 429
+                allowed, retry_after = state['buckets'].take(keys, 1, rate, burst)
+                if not allowed:
+                    return too_many('rate limit exceeded', 429, retry_after)
+                request_cost = cost()
+                if request_cost > burst:
+                    return jsonify({'error': 'request costs more than the rate-limit burst'}), 413
+                if request_cost > 1:
+                    allowed, retry_after = state['buckets'].take(keys, request_cost - 1, rate, burst)
+                    if not allowed:
+                        return too_many('rate limit exceeded', 429, retry_after)
+            except sqlite3.Error as e:
+                print(f"Rate limiter unavailable, admitting request: {e}")
+
+            # Finish reading the upload first, so a slow client never holds an inference slot
+            request.get_data(cache=True)
+            slot = state['inflight'].acquire()
+            if slot is None:
+                return too_many('server busy, try again shortly', 503, 1)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                state['inflight'].release(slot)
+        return wrapped
+    return decorator
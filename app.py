@@ -1,11 +1,18 @@
 import os
 from flask import Flask, request, jsonify, render_template, send_file
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import base64
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, date, timedelta
 import io
 import random
-from PIL import Image, ImageOps, ImageStat
+import time
+from PIL import ImageStat
+from ml.preprocessing import decode_image_data, prepare_sketch_image
+from ml.dataset_manifest import load_summary, refresh_manifest, summarize_manifest, summary_path
+from ml.sketch_index import SketchIndex, append_records, sketch_hash, write_index
+from admission import admission_controlled, configure as configure_admission
 
 try:
     from ml.sketch_cnn_model import get_model
@@ -24,9 +31,16 @@ else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///mood_app.db'
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['MAX_BATCH_SIZE'] = int(os.environ.get('MAX_BATCH_SIZE', 64))
+app.config['SIMILARITY_INDEX_PATH'] = os.environ.get('SIMILARITY_INDEX_PATH', os.path.join(app.config['UPLOAD_FOLDER'], 'sketch_index.bin'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+configure_admission(app)
+if int(os.environ.get('PROXY_COUNT', 0)):
+    # Behind a load balancer remote_addr is the proxy; trust that many X-Forwarded-For hops
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ['PROXY_COUNT']))
+
 class History(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -49,6 +63,62 @@ class History(db.Model):
             'relabel': self.relabel
         }
 
+class MoodDailyRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    mood = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+    __table_args__ = (db.UniqueConstraint('day', 'mood'),)
+
+class RatingRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mood = db.Column(db.String(50), nullable=False)
+    track_path = db.Column(db.String(200), nullable=False)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('mood', 'track_path'),)
+
+class RelabelRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mood_pred = db.Column(db.String(50), nullable=False)
+    relabel = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('mood_pred', 'relabel'),)
+
+def bump_rollup(model, keys, **increments):
+    """Add increments to the rollup row for keys with a single INSERT ... ON CONFLICT DO UPDATE
+
+    The upsert is atomic, so two workers creating the same (day, mood) row at
+    once both land their increment instead of one hitting the unique constraint.
+    """
+    insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    stmt = insert(model).values(**keys, **increments)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: getattr(model, name) + stmt.excluded[name] for name in increments}
+    )
+    db.session.execute(stmt)
+
+def move_prediction_rollups(entry, mood, confidence):
+    """Move a History row's rollup contributions from its stored prediction to a new one
+
+    Call in the same transaction that rewrites entry.mood_pred, so re-scored
+    rows never leave rollups keyed by a mood History no longer holds.
+    """
+    day = entry.timestamp.date()
+    if entry.mood_pred is not None:
+        bump_rollup(MoodDailyRollup, {'day': day, 'mood': entry.mood_pred}, count=-1, confidence_sum=-(entry.confidence or 0.0))
+    bump_rollup(MoodDailyRollup, {'day': day, 'mood': mood}, count=1, confidence_sum=confidence)
+    if mood == entry.mood_pred:
+        return
+    if entry.rating is not None:
+        bump_rollup(RatingRollup, {'mood': entry.mood_pred, 'track_path': entry.track_path}, rating_count=-1, rating_sum=-entry.rating)
+        bump_rollup(RatingRollup, {'mood': mood, 'track_path': entry.track_path}, rating_count=1, rating_sum=entry.rating)
+    if entry.relabel:
+        bump_rollup(RelabelRollup, {'mood_pred': entry.mood_pred, 'relabel': entry.relabel}, count=-1)
+        bump_rollup(RelabelRollup, {'mood_pred': mood, 'relabel': entry.relabel}, count=1)
+
 if USE_TENSORFLOW:
     MODEL = get_model()
     print(f"🤖 Using TensorFlow CNN model")
@@ -70,6 +140,9 @@ else:
                 mood = random.choice(['sad','energetic'])
                 conf = 0.55
             return mood, min(max(conf, 0.0), 0.99)
+
+        def predict_batch_from_pil(self, pil_imgs):
+            return [self.predict_from_pil(img) for img in pil_imgs]
     
     MODEL = DummyMoodModel()
     print("⚠️  Using fallback dummy model")
@@ -80,6 +153,8 @@ MOOD_AUDIO = {
     'energetic': ['static/audio/energetic1.wav', 'static/audio/energetic2.wav']
 }
 
+SIMILARITY_INDEX = SketchIndex(app.config['SIMILARITY_INDEX_PATH'])
+
 with app.app_context():
     db.create_all()
 
@@ -92,34 +167,48 @@ def history():
     entries = History.query.order_by(History.timestamp.desc()).all()
     return render_template('index.html', entries=entries)
 
+def batch_cost():
+    """One token per image; an oversized batch is refused by the view before decoding, so it costs one"""
+    payload = request.get_json(silent=True)
+    images = payload.get('images') if isinstance(payload, dict) else None
+    if not isinstance(images, list) or not images or len(images) > app.config['MAX_BATCH_SIZE']:
+        return 1
+    return len(images)
+
 @app.route('/predict', methods=['POST'])
+@admission_controlled(app, max_body=lambda: app.config['MAX_IMAGE_CHARS'] + 1024)
 def predict():
     data = request.json.get('image')
     if not data:
         return jsonify({'error': 'no image received'}), 400
+    if len(data) > app.config['MAX_IMAGE_CHARS']:
+        return jsonify({'error': 'image too large'}), 413
 
-    header, b64 = data.split(',', 1) if ',' in data else (None, data)
-    image_bytes = base64.b64decode(b64)
+    image_bytes = decode_image_data(data)
 
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    timestamp = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    created = datetime.utcnow()
+    timestamp = created.strftime('%Y%m%d%H%M%S%f')
     image_path = os.path.join(app.config['UPLOAD_FOLDER'], f'sketch_{timestamp}.png')
     with open(image_path, 'wb') as f:
         f.write(image_bytes)
 
-    img = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
-    background = Image.new('RGBA', img.size, (255, 255, 255, 255))
-    image_merged = Image.alpha_composite(background, img).convert('RGB')
-    image_resized = ImageOps.fit(image_merged, (64, 64)).convert('L')
+    image_resized = prepare_sketch_image(image_bytes)
 
     mood, confidence = MODEL.predict_from_pil(image_resized)
 
     track = random.choice(MOOD_AUDIO.get(mood, []))
 
-    h = History(mood_pred=mood, confidence=float(confidence), track_path=track, image_path=image_path)
+    h = History(timestamp=created, mood_pred=mood, confidence=float(confidence), track_path=track, image_path=image_path)
     db.session.add(h)
+    bump_rollup(MoodDailyRollup, {'day': created.date(), 'mood': mood}, count=1, confidence_sum=float(confidence))
     db.session.commit()
 
+    try:
+        SIMILARITY_INDEX.add(h.id, sketch_hash(image_resized))
+    except Exception as e:
+        print(f"Similarity index error: {e}")
+
     return jsonify({
         'mood': mood,
         'confidence': float(confidence),
@@ -128,6 +217,59 @@ def predict():
     })
 
 
+@app.route('/predict/batch', methods=['POST'])
+@admission_controlled(app, cost=batch_cost)
+def predict_batch():
+    """Score many images in one request without touching uploads/ or History"""
+    payload = request.get_json(silent=True)
+    images = payload.get('images') if isinstance(payload, dict) else None
+    if not images or not isinstance(images, list):
+        return jsonify({'error': 'no images received'}), 400
+    if len(images) > app.config['MAX_BATCH_SIZE']:
+        return jsonify({'error': f"batch too large (max {app.config['MAX_BATCH_SIZE']})"}), 413
+
+    results = [None] * len(images)
+    prepared = []
+    positions = []
+    for i, data in enumerate(images):
+        if not isinstance(data, str) or len(data) > app.config['MAX_IMAGE_CHARS']:
+            results[i] = {'error': 'invalid image'}
+            continue
+        try:
+            prepared.append(prepare_sketch_image(decode_image_data(data)))
+            positions.append(i)
+        except Exception:
+            results[i] = {'error': 'invalid image'}
+
+    if prepared:
+        for i, (mood, confidence) in zip(positions, MODEL.predict_batch_from_pil(prepared)):
+            results[i] = {'mood': mood, 'confidence': float(confidence)}
+
+    return jsonify({'results': results})
+
+@app.route('/similar/<int:history_id>')
+def similar(history_id):
+    """Past sketches whose perceptual hash is close to this entry's"""
+    k = max(1, min(request.args.get('k', 10, type=int), 100))
+    max_distance = request.args.get('max_distance', 10, type=int)
+
+    hash_value = SIMILARITY_INDEX.hash_for(history_id)
+    if hash_value is None:
+        entry = History.query.get(history_id)
+        if not entry or not entry.image_path or not os.path.exists(entry.image_path):
+            return jsonify({'error': 'not found'}), 404
+        with open(entry.image_path, 'rb') as f:
+            hash_value = sketch_hash(prepare_sketch_image(f.read()))
+
+    matches = SIMILARITY_INDEX.query(hash_value, k=k, max_distance=max_distance, exclude_id=history_id)
+    entries = {e.id: e for e in History.query.filter(History.id.in_([hid for hid, _ in matches]))}
+    return jsonify({
+        'history_id': history_id,
+        'matches': [
+            {**entries[hid].as_dict(), 'distance': distance}
+            for hid, distance in matches if hid in entries
+        ]
+    })
 
 @app.route('/rate', methods=['POST'])
 def rate():
@@ -135,9 +277,11 @@ def rate():
     hid = payload.get('history_id')
     rating = payload.get('rating')
     relabel = payload.get('relabel')
-    entry = History.query.get(hid)
+    # Row lock so a concurrent re-score can't change mood_pred between reading it and bumping its rollups
+    entry = db.session.get(History, hid, with_for_update=True)
     if not entry:
         return jsonify({'error': 'not found'}), 404
+    old_rating, old_relabel = entry.rating, entry.relabel
     if rating is not None:
         try:
             entry.rating = int(rating)
@@ -145,40 +289,188 @@ def rate():
             pass
     if relabel:
         entry.relabel = relabel
+
+    if entry.rating != old_rating:
+        rating_keys = {'mood': entry.mood_pred, 'track_path': entry.track_path}
+        if old_rating is not None:
+            bump_rollup(RatingRollup, rating_keys, rating_count=-1, rating_sum=-old_rating)
+        bump_rollup(RatingRollup, rating_keys, rating_count=1, rating_sum=entry.rating)
+    if entry.relabel != old_relabel:
+        if old_relabel:
+            bump_rollup(RelabelRollup, {'mood_pred': entry.mood_pred, 'relabel': old_relabel}, count=-1)
+        bump_rollup(RelabelRollup, {'mood_pred': entry.mood_pred, 'relabel': entry.relabel}, count=1)
     db.session.commit()
     return jsonify({'ok': True, 'entry': entry.as_dict()})
 
+MODEL_PATH = os.environ.get('SKETCH_MODEL_PATH', 'ml/sketch_mood_model.h5')
+DATASET_PATH = 'ml/dataset'
+MODEL_STATUS_TTL = float(os.environ.get('MODEL_STATUS_TTL', 30))
+_dataset_status = {'checked_at': 0.0, 'summary_mtime': None, 'model_exists': False, 'summary': None}
+
+def dataset_status():
+    """Model file and dataset manifest summary, re-checked at most once per MODEL_STATUS_TTL seconds"""
+    now = time.monotonic()
+    if now - _dataset_status['checked_at'] < MODEL_STATUS_TTL:
+        return _dataset_status
+    _dataset_status['checked_at'] = now
+    _dataset_status['model_exists'] = os.path.exists(MODEL_PATH)
+
+    try:
+        summary_mtime = os.stat(summary_path(DATASET_PATH)).st_mtime
+    except OSError:
+        summary_mtime = None
+
+    if summary_mtime is None and os.path.isdir(DATASET_PATH):
+        # First look at a dataset nobody has indexed yet: build the manifest once
+        _dataset_status['summary'] = summarize_manifest(refresh_manifest(DATASET_PATH, hash_files=False))
+        _dataset_status['summary_mtime'] = os.stat(summary_path(DATASET_PATH)).st_mtime
+    elif summary_mtime != _dataset_status['summary_mtime']:
+        # Only the small summary file is parsed here, never the per-file manifest
+        _dataset_status['summary'] = load_summary(DATASET_PATH)
+        _dataset_status['summary_mtime'] = summary_mtime
+
+    return _dataset_status
+
 @app.route('/model-status')
 def model_status():
     """Check model status and training information"""
+    cached = dataset_status()
     status = {
         'using_tensorflow': USE_TENSORFLOW,
         'model_type': 'TensorFlow CNN' if USE_TENSORFLOW else 'Dummy Model',
-        'model_path': 'ml/sketch_mood_model.h5',
-        'model_exists': os.path.exists('ml/sketch_mood_model.h5'),
-        'dataset_path': 'ml/dataset',
-        'dataset_exists': os.path.exists('ml/dataset'),
+        'model_path': MODEL_PATH,
+        'model_exists': cached['model_exists'],
+        'dataset_path': DATASET_PATH,
+        'dataset_exists': cached['summary'] is not None,
         'training_instructions': {
             'setup_dataset': 'python ml/setup_dataset.py --output ml/dataset --synthetic',
             'train_model': 'python ml/train_model.py --dataset_path ml/dataset'
         }
     }
     
-    if status['dataset_exists']:
-        dataset_info = {}
-        for mood in ['happy', 'calm', 'sad', 'energetic']:
-            mood_path = os.path.join('ml/dataset', mood)
-            if os.path.exists(mood_path):
-                image_count = len([f for f in os.listdir(mood_path) 
-                                 if f.lower().endswith(('.png', '.jpg', '.jpeg'))])
-                dataset_info[mood] = image_count
-            else:
-                dataset_info[mood] = 0
-        status['dataset_info'] = dataset_info
-        status['total_images'] = sum(dataset_info.values())
+    if cached['summary']:
+        status.update(cached['summary'])
     
     return jsonify(status)
 
+@app.route('/analytics/moods')
+def analytics_moods():
+    """Daily prediction counts per mood, read from the MoodDailyRollup table"""
+    days = request.args.get('days', 30, type=int)
+    since = datetime.utcnow().date() - timedelta(days=max(days, 1) - 1)
+    series = {}
+    totals = {}
+    for row in MoodDailyRollup.query.filter(MoodDailyRollup.day >= since).order_by(MoodDailyRollup.day.asc()):
+        series.setdefault(row.day.isoformat(), {})[row.mood] = row.count
+        totals[row.mood] = totals.get(row.mood, 0) + row.count
+    return jsonify({
+        'since': since.isoformat(),
+        'days': [{'day': day, 'counts': counts} for day, counts in series.items()],
+        'totals': totals
+    })
+
+@app.route('/analytics/confidence')
+def analytics_confidence():
+    """Average model confidence per mood"""
+    rows = (db.session.query(MoodDailyRollup.mood,
+                             db.func.sum(MoodDailyRollup.count),
+                             db.func.sum(MoodDailyRollup.confidence_sum))
+            .group_by(MoodDailyRollup.mood).all())
+    return jsonify({
+        mood: {'count': int(count), 'average_confidence': confidence_sum / count if count else None}
+        for mood, count, confidence_sum in rows
+    })
+
+@app.route('/analytics/ratings')
+def analytics_ratings():
+    """Average user rating per predicted mood and per track"""
+    by_mood = {}
+    by_track = []
+    for row in RatingRollup.query.filter(RatingRollup.rating_count > 0):
+        mood_stats = by_mood.setdefault(row.mood, {'rating_count': 0, 'rating_sum': 0})
+        mood_stats['rating_count'] += row.rating_count
+        mood_stats['rating_sum'] += row.rating_sum
+        by_track.append({
+            'mood': row.mood,
+            'track_path': row.track_path,
+            'rating_count': row.rating_count,
+            'average_rating': row.rating_sum / row.rating_count
+        })
+    return jsonify({
+        'moods': {
+            mood: {'rating_count': stats['rating_count'], 'average_rating': stats['rating_sum'] / stats['rating_count']}
+            for mood, stats in by_mood.items()
+        },
+        'tracks': by_track
+    })
+
+@app.route('/analytics/confusion')
+def analytics_confusion():
+    """Predicted mood vs. user relabel counts"""
+    matrix = {}
+    for row in RelabelRollup.query.filter(RelabelRollup.count > 0):
+        matrix.setdefault(row.mood_pred, {})[row.relabel] = row.count
+    return jsonify({'confusion': matrix})
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups():
+    """Rebuild every analytics rollup table from the History table"""
+    for model in (MoodDailyRollup, RatingRollup, RelabelRollup):
+        model.query.delete()
+
+    day = db.func.date(History.timestamp)
+    for row_day, mood, count, confidence_sum in (
+            db.session.query(day, History.mood_pred, db.func.count(History.id), db.func.sum(History.confidence))
+            .filter(History.mood_pred.isnot(None))
+            .group_by(day, History.mood_pred)):
+        if isinstance(row_day, str):
+            row_day = date.fromisoformat(row_day)
+        db.session.add(MoodDailyRollup(day=row_day, mood=mood, count=count, confidence_sum=confidence_sum or 0.0))
+
+    for mood, track_path, count, rating_sum in (
+            db.session.query(History.mood_pred, History.track_path, db.func.count(History.id), db.func.sum(History.rating))
+            .filter(History.rating.isnot(None))
+            .group_by(History.mood_pred, History.track_path)):
+        db.session.add(RatingRollup(mood=mood, track_path=track_path, rating_count=count, rating_sum=rating_sum))
+
+    for mood_pred, relabel, count in (
+            db.session.query(History.mood_pred, History.relabel, db.func.count(History.id))
+            .filter(History.relabel.isnot(None), History.relabel != '')
+            .group_by(History.mood_pred, History.relabel)):
+        db.session.add(RelabelRollup(mood_pred=mood_pred, relabel=relabel, count=count))
+
+    db.session.commit()
+    print("✅ Analytics rollups rebuilt from History")
+
+@app.cli.command('build-similarity-index')
+def build_similarity_index():
+    """Rebuild the similarity index file from every stored History upload
+
+    Safe to run while the app is serving: rows committed after the rebuild's
+    last read may have been appended to the replaced file, so they are hashed
+    again and appended to the new one afterwards.
+    """
+    last_seen = {'id': 0}
+
+    def hashed_rows(after_id):
+        while True:
+            rows = (History.query.with_entities(History.id, History.image_path)
+                    .filter(History.id > after_id).order_by(History.id.asc()).limit(1000).all())
+            if not rows:
+                return
+            for history_id, image_path in rows:
+                try:
+                    with open(image_path, 'rb') as f:
+                        yield history_id, sketch_hash(prepare_sketch_image(f.read()))
+                except Exception as e:
+                    print(f"Error hashing {image_path}: {e}")
+            after_id = last_seen['id'] = rows[-1].id
+
+    index_path = app.config['SIMILARITY_INDEX_PATH']
+    count = write_index(index_path, hashed_rows(0))
+    count += append_records(index_path, hashed_rows(last_seen['id']))
+    print(f"✅ Indexed {count} sketches into {index_path}")
+
 @app.route('/export.csv')
 def export_csv():
     import csv
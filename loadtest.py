@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import io
+import time
+import base64
+import random
+import argparse
+import threading
+import multiprocessing
+
+import requests
+from PIL import Image, ImageDraw
+
+
+def make_canvas(size, noisy=False):
+    """Return a data-URL PNG: a small doodle, or a large noise image that is expensive to decode"""
+    if noisy:
+        img = Image.effect_noise((size, size), 128).convert('RGBA')
+    else:
+        img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        draw.ellipse([size // 6, size // 6, size * 5 // 6, size * 5 // 6], outline='black', width=4)
+        draw.arc([size // 3, size // 3, size * 2 // 3, size * 2 // 3], 0, 180, fill='black', width=4)
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_client(url, image, client_ip, stop_at, interval, stats, lock):
+    """Post the same image until stop_at, pausing interval seconds between requests"""
+    session = requests.Session()
+    headers = {'X-Forwarded-For': client_ip}
+    if interval:
+        # Real users don't fire in lockstep; without this every round collides on the same instant
+        time.sleep(random.uniform(0, interval))
+    while time.time() < stop_at:
+        started = time.perf_counter()
+        try:
+            status = session.post(url + '/predict', json={'image': image}, headers=headers, timeout=30).status_code
+        except requests.RequestException:
+            status = 'error'
+        elapsed = time.perf_counter() - started
+        with lock:
+            stats['latencies'].append(elapsed)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+        if interval:
+            time.sleep(interval)
+
+
+def run_group(url, size, noisy, client_ips, threads_per_client, interval, duration):
+    """Run one class of clients in its own process, so the groups don't share a GIL and skew each other's timings"""
+    image = make_canvas(size, noisy=noisy)
+    lock = threading.Lock()
+    stats = {'latencies': [], 'statuses': {}}
+    stop_at = time.time() + duration
+    threads = [
+        threading.Thread(target=run_client, args=(url, image, ip, stop_at, interval, stats, lock))
+        for ip in client_ips for _ in range(threads_per_client)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return stats
+
+
+def run_load_test(url, duration=30, legit_clients=5, legit_interval=3.0, abusers=4, abuser_threads=8, abuser_size=2048):
+    print("🔨 Starting /predict load test...")
+    print(f"Target: {url} (run the app with PROXY_COUNT=1 so simulated client IPs are honoured)")
+    print(f"Legitimate clients: {legit_clients}, one request every {legit_interval}s")
+    print(f"Abusive clients: {abusers} x {abuser_threads} threads, {abuser_size}x{abuser_size} noise canvases, no pause")
+    print("-" * 50)
+
+    with multiprocessing.Pool(processes=2) as pool:
+        legit_job = pool.apply_async(run_group, (
+            url, 400, False, [f'10.0.0.{i + 1}' for i in range(legit_clients)], 1, legit_interval, duration
+        ))
+        abusive_job = pool.apply_async(run_group, (
+            url, abuser_size, True, [f'10.0.1.{i + 1}' for i in range(abusers)], abuser_threads, 0, duration
+        ))
+        legit, abusive = legit_job.get(), abusive_job.get()
+
+    print("\n" + "="*50)
+    print("📊 RESULTS")
+    print("="*50)
+    for name, stats in (('legitimate', legit), ('abusive', abusive)):
+        latencies = [l * 1000 for l in stats['latencies']]
+        print(f"{name}: {len(latencies)} requests, statuses {stats['statuses']}")
+        print(f"  p50 {percentile(latencies, 50):.1f}ms  p99 {percentile(latencies, 99):.1f}ms  max {max(latencies, default=float('nan')):.1f}ms")
+    return legit, abusive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure legitimate-user /predict latency while abusive clients flood the server")
+    parser.add_argument("--url", type=str, default="http://localhost:5000", help="Base URL of the running app")
+    parser.add_argument("--duration", type=int, default=30, help="Test length in seconds")
+    parser.add_argument("--legit_clients", type=int, default=5, help="Well-behaved clients")
+    parser.add_argument("--legit_interval", type=float, default=3.0, help="Seconds between legitimate requests")
+    parser.add_argument("--abusers", type=int, default=4, help="Abusive client IPs")
+    parser.add_argument("--abuser_threads", type=int, default=8, help="Concurrent connections per abusive client")
+    parser.add_argument("--abuser_size", type=int, default=2048, help="Abusive canvas width/height in pixels")
+
+    args = parser.parse_args()
+
+    run_load_test(
+        args.url,
+        duration=args.duration,
+        legit_clients=args.legit_clients,
+        legit_interval=args.legit_interval,
+        abusers=args.abusers,
+        abuser_threads=args.abuser_threads,
+        abuser_size=args.abuser_size
+    )
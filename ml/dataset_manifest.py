@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import tempfile
+from datetime import datetime
+
+MOODS = ['happy', 'calm', 'sad', 'energetic']
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MANIFEST_NAME = 'manifest.json'
+SUMMARY_NAME = 'manifest_summary.json'
+
+
+def manifest_path(dataset_path):
+    return os.path.join(dataset_path, MANIFEST_NAME)
+
+
+def summary_path(dataset_path):
+    return os.path.join(dataset_path, SUMMARY_NAME)
+
+
+def _write_json_atomic(path, data):
+    """Write to a unique temp file beside path, then rename it over path
+
+    Several processes (app workers, setup_dataset, train_model) may refresh at
+    once; unique temp names keep them from moving or truncating each other's files.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_summary(dataset_path):
+    """Return the small per-mood summary written next to the manifest, or None"""
+    try:
+        with open(summary_path(dataset_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_manifest(dataset_path):
+    """Return the saved manifest for dataset_path, or None if there isn't one"""
+    try:
+        with open(manifest_path(dataset_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _scan_mood(mood_path, previous, hash_files):
+    """Stat every image in mood_path, reusing entries whose size and mtime are unchanged"""
+    previous_files = previous.get('files', {}) if previous else {}
+    files = {}
+    with os.scandir(mood_path) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            old = previous_files.get(entry.name)
+            if old and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime and (old.get('sha1') or not hash_files):
+                files[entry.name] = old
+            else:
+                files[entry.name] = {
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'sha1': _file_hash(entry.path) if hash_files else None
+                }
+    return files
+
+
+def refresh_manifest(dataset_path, hash_files=True, force=False):
+    """Bring the manifest up to date, rescanning only mood folders whose mtime changed
+
+    Overwriting a file in place doesn't touch its folder's mtime, so tools that
+    rewrite existing files pass force=True to stat every file again.
+    """
+    previous = load_manifest(dataset_path) or {}
+    previous_moods = previous.get('moods', {})
+    moods = {}
+
+    for mood in MOODS:
+        mood_path = os.path.join(dataset_path, mood)
+        old = previous_moods.get(mood)
+        try:
+            dir_mtime = os.stat(mood_path).st_mtime
+        except OSError:
+            moods[mood] = {'dir_mtime': None, 'count': 0, 'total_bytes': 0, 'last_modified': None, 'files': {}}
+            continue
+
+        if not force and old and old.get('dir_mtime') == dir_mtime and (old.get('hashed') or not hash_files):
+            moods[mood] = old
+            continue
+
+        files = _scan_mood(mood_path, old, hash_files)
+        last_modified = max((f['mtime'] for f in files.values()), default=None)
+        moods[mood] = {
+            'dir_mtime': dir_mtime,
+            'count': len(files),
+            'total_bytes': sum(f['size'] for f in files.values()),
+            'last_modified': datetime.utcfromtimestamp(last_modified).isoformat() if last_modified else None,
+            'hashed': hash_files,
+            'files': files
+        }
+
+    manifest = {
+        'dataset_path': dataset_path,
+        'updated': datetime.utcnow().isoformat(),
+        'moods': moods
+    }
+
+    if os.path.isdir(dataset_path):
+        _write_json_atomic(manifest_path(dataset_path), manifest)
+        _write_json_atomic(summary_path(dataset_path), summarize_manifest(manifest))
+
+    return manifest
+
+
+def summarize_manifest(manifest):
+    """Per-mood counts and sizes without the per-file listing"""
+    dataset_info = {mood: info['count'] for mood, info in manifest['moods'].items()}
+    return {
+        'dataset_info': dataset_info,
+        'total_images': sum(dataset_info.values()),
+        'total_bytes': sum(info['total_bytes'] for info in manifest['moods'].values()),
+        'last_modified': max((info['last_modified'] for info in manifest['moods'].values() if info['last_modified']), default=None),
+        'manifest_updated': manifest['updated']
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Refresh the dataset manifest used by /model-status and training")
+    parser.add_argument("--dataset_path", type=str, default="ml/dataset", help="Path to dataset folder")
+    parser.add_argument("--no_hash", action="store_true", help="Skip content hashes (counts and sizes only)")
+
+    args = parser.parse_args()
+
+    summary = summarize_manifest(refresh_manifest(args.dataset_path, hash_files=not args.no_hash))
+    print(f"📋 Manifest written to: {manifest_path(args.dataset_path)}")
+    for mood, count in summary['dataset_info'].items():
+        print(f"  {mood}: {count} images")
+    print(f"Total: {summary['total_images']} images, {summary['total_bytes']} bytes")
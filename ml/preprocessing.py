@@ -0,0 +1,27 @@
+import base64
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+
+def decode_image_data(data):
+    """Decode a data-URL or bare base64 string into raw image bytes"""
+    header, b64 = data.split(',', 1) if ',' in data else (None, data)
+    return base64.b64decode(b64)
+
+
+def prepare_sketch_image(image_bytes, size=(64, 64)):
+    """Flatten a canvas upload onto white and shrink it to the grayscale model input"""
+    img = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
+    background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+    image_merged = Image.alpha_composite(background, img).convert('RGB')
+    return ImageOps.fit(image_merged, size).convert('L')
+
+
+def resize_batch(images, size):
+    """Resize an (N, H, W[, 1]) image batch to (N, size, size, 1), or return it unchanged if already that size"""
+    import cv2
+    if images.shape[1] == size:
+        return np.asarray(images)
+    return np.stack([cv2.resize(np.asarray(img), (size, size)) for img in images])[..., np.newaxis]
@@ -0,0 +1,153 @@
+import os
+import sys
+import csv
+import json
+import argparse
+import time
+import multiprocessing
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml.preprocessing import prepare_sketch_image
+
+
+def load_history_image(item):
+    """Read and preprocess one stored upload (runs inside a worker process)"""
+    history_id, image_path = item
+    try:
+        with open(image_path, 'rb') as f:
+            image = prepare_sketch_image(f.read())
+        return history_id, image.tobytes()
+    except Exception as e:
+        print(f"Error loading {image_path}: {e}")
+        return history_id, None
+
+
+def load_checkpoint(checkpoint_path):
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            return json.load(f).get('last_id', 0)
+    return 0
+
+
+def save_checkpoint(checkpoint_path, last_id):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'last_id': last_id}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def rescore_history(mode='diff', output='ml/rescore_diff.csv', checkpoint='ml/rescore_checkpoint.json',
+                    chunk_size=512, workers=None, restart=False):
+
+    workers = workers or os.cpu_count()
+
+    # Imported here so spawned decode workers don't each load the model
+    from app import app, db, History, MODEL, USE_TENSORFLOW, move_prediction_rollups
+
+    # The app silently falls back to a random dummy model; never write its guesses over real predictions
+    if not USE_TENSORFLOW or not MODEL.loaded:
+        print("❌ No trained TensorFlow model is loaded - refusing to re-score with the fallback model")
+        print("Train one first: python ml/train_model.py --dataset_path ml/dataset")
+        sys.exit(1)
+
+    print("🔁 Re-scoring stored sketches...")
+    print(f"Mode: {mode}")
+    print(f"Chunk size: {chunk_size}")
+    print(f"Workers: {workers}")
+    print("-" * 50)
+
+    if restart:
+        for path in (checkpoint, output if mode == 'diff' else None):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    last_id = load_checkpoint(checkpoint)
+    if last_id:
+        print(f"↪️  Resuming after history id {last_id}")
+
+    diff_file = None
+    diff_writer = None
+    if mode == 'diff':
+        write_header = not os.path.exists(output)
+        diff_file = open(output, 'a', newline='')
+        diff_writer = csv.writer(diff_file)
+        if write_header:
+            diff_writer.writerow(['id', 'image_path', 'old_mood', 'new_mood', 'old_confidence', 'new_confidence'])
+
+    processed = 0
+    changed = 0
+    started = time.time()
+
+    with app.app_context(), multiprocessing.get_context('spawn').Pool(processes=workers) as pool:
+        while True:
+            query = History.query.filter(History.id > last_id).order_by(History.id.asc()).limit(chunk_size)
+            if mode == 'update':
+                # Held until the chunk commits, so /rate can't bump rollups under a mood we are replacing
+                query = query.with_for_update()
+            rows = query.all()
+            if not rows:
+                break
+
+            loaded = pool.map(load_history_image, [(r.id, r.image_path) for r in rows if r.image_path])
+            images = {hid: Image.frombytes('L', (64, 64), data) for hid, data in loaded if data is not None}
+
+            scored_rows = [r for r in rows if r.id in images]
+            # predict_batch raises instead of falling back, so a failed chunk stops the run before its checkpoint
+            predictions = MODEL.predict_batch([images[r.id] for r in scored_rows]) if scored_rows else []
+
+            updates = []
+            for r, (mood, confidence) in zip(scored_rows, predictions):
+                confidence = float(confidence)
+                if mood != r.mood_pred:
+                    changed += 1
+                if diff_writer:
+                    diff_writer.writerow([r.id, r.image_path, r.mood_pred, mood, r.confidence, confidence])
+                elif mood != r.mood_pred or confidence != r.confidence:
+                    # Same transaction as the History update, so the analytics rollups never drift from it
+                    move_prediction_rollups(r, mood, confidence)
+                    updates.append({'id': r.id, 'mood_pred': mood, 'confidence': confidence})
+
+            if updates:
+                db.session.bulk_update_mappings(History, updates)
+            db.session.commit()
+            if diff_file:
+                diff_file.flush()
+
+            processed += len(scored_rows)
+            last_id = rows[-1].id
+            save_checkpoint(checkpoint, last_id)
+
+            elapsed = time.time() - started
+            print(f"  ✅ Scored {processed} sketches ({changed} changed) - {processed / max(elapsed, 1e-9):.1f} sketches/sec")
+
+    if diff_file:
+        diff_file.close()
+
+    print(f"\n✅ Re-scoring completed: {processed} sketches, {changed} with a different mood")
+    if mode == 'diff':
+        print(f"Diff written to: {output}")
+    print(f"Checkpoint: {checkpoint} (use --restart to start over)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score stored History sketches with the current model")
+    parser.add_argument("--mode", choices=['diff', 'update'], default='diff', help="Write a CSV diff or update History rows in place")
+    parser.add_argument("--output", type=str, default="ml/rescore_diff.csv", help="Diff CSV path (diff mode)")
+    parser.add_argument("--checkpoint", type=str, default="ml/rescore_checkpoint.json", help="Resume checkpoint path")
+    parser.add_argument("--chunk_size", type=int, default=512, help="History rows per batch")
+    parser.add_argument("--workers", type=int, default=None, help="Image decode processes (default: all cores)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the first row")
+
+    args = parser.parse_args()
+
+    rescore_history(
+        mode=args.mode,
+        output=args.output,
+        checkpoint=args.checkpoint,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        restart=args.restart
+    )
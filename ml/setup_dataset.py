@@ -1,9 +1,16 @@
 
 
 import os
+import sys
 import numpy as np
 from PIL import Image, ImageDraw
 import random
+import time
+import multiprocessing
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml.dataset_manifest import refresh_manifest, manifest_path
 
 def create_dataset_structure(output_path):
     moods = ['happy', 'calm', 'sad', 'energetic']
@@ -16,52 +23,52 @@ def create_dataset_structure(output_path):
     print(f"\n✅ Dataset structure created at: {output_path}")
     return output_path
 
-def generate_simple_synthetic_doodles(dataset_path, samples_per_mood=50):
+def draw_happy_doodle(rng=random):
+    img = Image.new('RGB', (64, 64), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([10, 10, 54, 54], outline='black', width=2)
+    draw.ellipse([20, 20, 25, 25], fill='black')
+    draw.ellipse([39, 20, 44, 25], fill='black')
+    draw.arc([20, 25, 44, 45], 0, 180, fill='black', width=2)
+    return img
+
+def draw_calm_doodle(rng=random):
+    img = Image.new('RGB', (64, 64), 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(20, 50, 8):
+        for x in range(0, 64, 4):
+            draw.ellipse([x, y + rng.randint(-2, 2), x+2, y+2], fill='black')
+    return img
+
+def draw_sad_doodle(rng=random):
+    img = Image.new('RGB', (64, 64), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([10, 10, 54, 54], outline='black', width=2)
+    draw.ellipse([20, 20, 25, 25], fill='black')
+    draw.ellipse([39, 20, 44, 25], fill='black')
+    draw.arc([20, 35, 44, 55], 180, 360, fill='black', width=2)
+    draw.ellipse([18, 30, 22, 40], fill='blue')
+    return img
+
+def draw_energetic_doodle(rng=random):
+    img = Image.new('RGB', (64, 64), 'white')
+    draw = ImageDraw.Draw(img)
+    points = [(25, 5), (35, 5), (20, 35), (30, 35), (15, 60), (40, 25), (30, 25), (45, 5)]
+    draw.polygon(points, fill='black')
+    return img
+
+MOOD_GENERATORS = {
+    'happy': draw_happy_doodle,
+    'calm': draw_calm_doodle,
+    'sad': draw_sad_doodle,
+    'energetic': draw_energetic_doodle
+}
+
+def generate_simple_synthetic_doodles(dataset_path, samples_per_mood=50, update_manifest=True):
     print("🎨 Generating synthetic doodles for testing...")
     print("⚠️  Note: These are simple shapes for testing only. Replace with real doodles!")
     
-    def draw_happy_doodle():
-        img = Image.new('RGB', (64, 64), 'white')
-        draw = ImageDraw.Draw(img)
-        draw.ellipse([10, 10, 54, 54], outline='black', width=2)
-        draw.ellipse([20, 20, 25, 25], fill='black')
-        draw.ellipse([39, 20, 44, 25], fill='black')
-        draw.arc([20, 25, 44, 45], 0, 180, fill='black', width=2)
-        return img
-    
-    def draw_calm_doodle():
-        img = Image.new('RGB', (64, 64), 'white')
-        draw = ImageDraw.Draw(img)
-        for y in range(20, 50, 8):
-            for x in range(0, 64, 4):
-                draw.ellipse([x, y + random.randint(-2, 2), x+2, y+2], fill='black')
-        return img
-    
-    def draw_sad_doodle():
-        img = Image.new('RGB', (64, 64), 'white')
-        draw = ImageDraw.Draw(img)
-        draw.ellipse([10, 10, 54, 54], outline='black', width=2)
-        draw.ellipse([20, 20, 25, 25], fill='black')
-        draw.ellipse([39, 20, 44, 25], fill='black')
-        draw.arc([20, 35, 44, 55], 180, 360, fill='black', width=2)
-        draw.ellipse([18, 30, 22, 40], fill='blue')
-        return img
-    
-    def draw_energetic_doodle():
-        img = Image.new('RGB', (64, 64), 'white')
-        draw = ImageDraw.Draw(img)
-        points = [(25, 5), (35, 5), (20, 35), (30, 35), (15, 60), (40, 25), (30, 25), (45, 5)]
-        draw.polygon(points, fill='black')
-        return img
-    
-    mood_generators = {
-        'happy': draw_happy_doodle,
-        'calm': draw_calm_doodle,
-        'sad': draw_sad_doodle,
-        'energetic': draw_energetic_doodle
-    }
-    
-    for mood, generator in mood_generators.items():
+    for mood, generator in MOOD_GENERATORS.items():
         mood_dir = os.path.join(dataset_path, mood)
         print(f"Generating {samples_per_mood} {mood} doodles...")
         
@@ -69,8 +76,6 @@ def generate_simple_synthetic_doodles(dataset_path, samples_per_mood=50):
 
             img = generator()
             
-            img_array = np.array(img)
-            
             angle = random.uniform(-10, 10)
             img = img.rotate(angle, fillcolor='white')
             
@@ -86,8 +91,114 @@ def generate_simple_synthetic_doodles(dataset_path, samples_per_mood=50):
         print(f"  ✅ Saved {samples_per_mood} images to {mood_dir}")
     
     print(f"\n✅ Generated {samples_per_mood * 4} synthetic doodles total")
+    if update_manifest:
+        refresh_manifest(dataset_path, force=True)
+        print(f"📋 Dataset manifest updated: {manifest_path(dataset_path)}")
     print("⚠️  Remember to replace these with real hand-drawn doodles for better accuracy!")
 
+def rotate_and_noise_batch(batch, np_rng, max_angle=10, noise_std=5, sub_batch=256):
+    """Randomly rotate and add Gaussian noise to a (N, H, W) uint8 batch, vectorized per sub-batch
+    
+    Coordinates and noise are float32 and only sub_batch images are in flight,
+    so the temporaries stay a few MB however large the shard is.
+    """
+    n, h, w = batch.shape
+    out = np.empty_like(batch)
+    ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+    dx, dy = xs - np.float32(w / 2), ys - np.float32(h / 2)
+    
+    for start in range(0, n, sub_batch):
+        part = batch[start:start + sub_batch]
+        m = len(part)
+        angles = np.deg2rad(np_rng.uniform(-max_angle, max_angle, m)).astype(np.float32)[:, None, None]
+        cos, sin = np.cos(angles), np.sin(angles)
+        
+        src_x = np.rint(cos * dx - sin * dy + np.float32(w / 2)).astype(np.int32)
+        src_y = np.rint(sin * dx + cos * dy + np.float32(h / 2)).astype(np.int32)
+        inside = (src_x >= 0) & (src_x < w) & (src_y >= 0) & (src_y < h)
+        np.clip(src_x, 0, w - 1, out=src_x)
+        np.clip(src_y, 0, h - 1, out=src_y)
+        
+        rotated = np.where(inside, part[np.arange(m)[:, None, None], src_y, src_x], np.float32(255))
+        rotated += np_rng.standard_normal(rotated.shape, dtype=np.float32) * np.float32(noise_std)
+        np.clip(rotated, 0, 255, out=rotated)
+        out[start:start + m] = rotated
+    return out
+
+def _generate_chunk(task):
+    """Worker: draw, rotate and noise one chunk of doodles, then write it as PNGs or an .npy shard"""
+    shard_idx, mood, start, count, seed_seq, output_path, output_format = task
+    np_rng = np.random.default_rng(seed_seq)
+    rng = random.Random(int(seed_seq.generate_state(1)[0]))
+    generator = MOOD_GENERATORS[mood]
+    
+    batch = np.stack([np.array(generator(rng).convert('L')) for _ in range(count)])
+    batch = rotate_and_noise_batch(batch, np_rng)
+    
+    if output_format == 'npy':
+        np.save(os.path.join(output_path, f"images_{shard_idx:05d}.npy"), batch)
+        np.save(os.path.join(output_path, f"labels_{shard_idx:05d}.npy"), np.full(count, mood))
+    else:
+        mood_dir = os.path.join(output_path, mood)
+        for i, img_array in enumerate(batch, start=start):
+            Image.fromarray(img_array).save(os.path.join(mood_dir, f"synthetic_{mood}_{i:06d}.png"))
+    
+    return count
+
+def generate_parallel_synthetic_doodles(output_path, samples_per_mood=50, workers=None,
+                                        output_format='png', shard_size=4096, seed=0, update_manifest=True):
+    """Generate doodles across a process pool, optionally packed into .npy shards for the trainer"""
+    workers = workers or os.cpu_count()
+    print(f"🎨 Generating {samples_per_mood * len(MOOD_GENERATORS)} synthetic doodles on {workers} workers ({output_format})...")
+    
+    os.makedirs(output_path, exist_ok=True)
+    tasks = []
+    for mood in MOOD_GENERATORS:
+        for start in range(0, samples_per_mood, shard_size):
+            tasks.append([len(tasks), mood, start, min(shard_size, samples_per_mood - start)])
+    for task, seed_seq in zip(tasks, np.random.SeedSequence(seed).spawn(len(tasks))):
+        task.extend([seed_seq, output_path, output_format])
+    
+    started = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(processes=workers) as pool:
+        total = sum(pool.imap_unordered(_generate_chunk, [tuple(t) for t in tasks]))
+    elapsed = time.perf_counter() - started
+    
+    if output_format == 'png' and update_manifest:
+        refresh_manifest(output_path, force=True)
+    
+    print(f"✅ Generated {total} synthetic doodles in {elapsed:.2f}s ({total / elapsed:.0f} samples/sec)")
+    return total, elapsed
+
+def benchmark_generation(samples_per_mood=500, workers=None, shard_size=4096):
+    """Compare samples/sec of the original per-image loop against the parallel generators"""
+    import tempfile
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        serial_path = create_dataset_structure(os.path.join(tmp, 'serial'))
+        started = time.perf_counter()
+        # Manifest refreshes (which hash every file) are left out of every timing
+        generate_simple_synthetic_doodles(serial_path, samples_per_mood, update_manifest=False)
+        results['serial png'] = samples_per_mood * len(MOOD_GENERATORS) / (time.perf_counter() - started)
+        
+        for output_format in ('png', 'npy'):
+            path = os.path.join(tmp, f'parallel_{output_format}')
+            if output_format == 'png':
+                create_dataset_structure(path)
+            total, elapsed = generate_parallel_synthetic_doodles(
+                path, samples_per_mood, workers=workers, output_format=output_format, shard_size=shard_size,
+                update_manifest=False
+            )
+            results[f'parallel {output_format}'] = total / elapsed
+    
+    print("\n" + "="*50)
+    print("⏱️  GENERATION THROUGHPUT")
+    print("="*50)
+    for name, rate in results.items():
+        print(f"  {name:<14} {rate:>10.0f} samples/sec")
+    return results
+
 if __name__ == "__main__":
     import argparse
     
@@ -95,13 +206,31 @@ if __name__ == "__main__":
     parser.add_argument("--output", type=str, default="ml/dataset", help="Output directory for dataset")
     parser.add_argument("--synthetic", action="store_true", help="Generate synthetic doodles for testing")
     parser.add_argument("--samples", type=int, default=50, help="Number of synthetic samples per mood")
+    parser.add_argument("--workers", type=int, default=1, help="Generator processes (0 = all cores, 1 = original serial loop)")
+    parser.add_argument("--format", choices=['png', 'npy'], default='png', help="Write PNG files or packed .npy shards")
+    parser.add_argument("--shard_size", type=int, default=4096, help="Samples per worker task / .npy shard")
+    parser.add_argument("--seed", type=int, default=0, help="Base seed for the per-worker random streams")
+    parser.add_argument("--benchmark", action="store_true", help="Measure generation throughput in samples/sec and exit")
     
     args = parser.parse_args()
     
-    dataset_path = create_dataset_structure(args.output)
+    if args.benchmark:
+        benchmark_generation(args.samples, workers=args.workers or None, shard_size=args.shard_size)
+        sys.exit(0)
+    
+    if args.format == 'npy':
+        dataset_path = args.output
+    else:
+        dataset_path = create_dataset_structure(args.output)
     
     if args.synthetic:
-        generate_simple_synthetic_doodles(dataset_path, args.samples)
+        if args.workers == 1 and args.format == 'png':
+            generate_simple_synthetic_doodles(dataset_path, args.samples)
+        else:
+            generate_parallel_synthetic_doodles(
+                dataset_path, args.samples, workers=args.workers or None,
+                output_format=args.format, shard_size=args.shard_size, seed=args.seed
+            )
         
         print("\n" + "="*50)
         print("🚀 NEXT STEPS:")
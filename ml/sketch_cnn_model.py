@@ -5,51 +5,123 @@ import numpy as np
 import cv2
 from PIL import Image, ImageOps, ImageStat
 import os
+import glob
+import time
 import pickle
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 import io
 import base64
+from ml.dataset_manifest import refresh_manifest
+
+DEFAULT_ARCHITECTURE = {
+    'filters': (32, 64, 128),
+    'dense_units': (512, 256),
+    'dropout': 0.5,
+    'input_size': 64,
+    'separable': False
+}
+
+# Small depthwise-separable network for distillation from the default model
+STUDENT_ARCHITECTURE = {
+    'filters': (16, 32, 64),
+    'dense_units': (64,),
+    'dropout': 0.2,
+    'input_size': 32,
+    'separable': True
+}
+
+class ShardBatches(keras.utils.PyDataset):
+    """Mini-batches gathered from uint8 shard memmaps and converted to float32 one batch at a time
+
+    labels is indexed by the same global sample index as the shards (strings or
+    one-hot rows); only the current batch is ever decoded into memory.
+    """
+    def __init__(self, shards, offsets, indices, labels, batch_size, input_shape, shuffle=False, seed=42, **kwargs):
+        super().__init__(**kwargs)
+        self.shards = shards
+        self.offsets = np.asarray(offsets)
+        self.indices = np.array(indices)
+        self.labels = labels
+        self.batch_size = batch_size
+        self.input_shape = input_shape
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        if shuffle:
+            self.rng.shuffle(self.indices)
+    
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+    
+    def __getitem__(self, batch):
+        idx = np.sort(self.indices[batch * self.batch_size:(batch + 1) * self.batch_size])
+        shard_ids = np.searchsorted(self.offsets, idx, side='right') - 1
+        
+        images = np.empty((len(idx),) + self.shards[0].shape[1:], dtype=np.uint8)
+        for shard_id in np.unique(shard_ids):
+            in_shard = shard_ids == shard_id
+            images[in_shard] = self.shards[shard_id][idx[in_shard] - self.offsets[shard_id]]
+        if images.shape[1:3] != tuple(self.input_shape[:2]):
+            images = np.stack([cv2.resize(img, tuple(self.input_shape[1::-1])) for img in images])
+        
+        return np.expand_dims(images.astype('float32') / 255.0, axis=-1), self.labels[idx]
+    
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.indices)
 
 class SketchMoodCNN:
-    def __init__(self, model_path='ml/sketch_mood_model.h5', label_encoder_path='ml/label_encoder.pkl'):
+    def __init__(self, model_path='ml/sketch_mood_model.h5', label_encoder_path='ml/label_encoder.pkl', architecture=None,
+                 load_existing=True):
         self.model_path = model_path
         self.label_encoder_path = label_encoder_path
         self.model = None
         self.label_encoder = None
-        self.input_shape = (64, 64, 1)
+        self.architecture = {**DEFAULT_ARCHITECTURE, **(architecture or {})}
+        self.input_shape = (self.architecture['input_size'], self.architecture['input_size'], 1)
         self.mood_classes = ['happy', 'calm', 'sad', 'energetic']
+        self.load_existing = load_existing
         
         self._load_or_create_model()
     
     def _create_model(self):
-        model = keras.Sequential([
-            layers.Conv2D(32, (3, 3), activation='relu', input_shape=self.input_shape),
-            layers.BatchNormalization(),
-            layers.Conv2D(32, (3, 3), activation='relu'),
-            layers.MaxPooling2D((2, 2)),
-            layers.Dropout(0.25),
-            
-            layers.Conv2D(64, (3, 3), activation='relu'),
-            layers.BatchNormalization(),
-            layers.Conv2D(64, (3, 3), activation='relu'),
-            layers.MaxPooling2D((2, 2)),
-            layers.Dropout(0.25),
-            
-            layers.Conv2D(128, (3, 3), activation='relu'),
-            layers.BatchNormalization(),
-            layers.Conv2D(128, (3, 3), activation='relu'),
-            layers.MaxPooling2D((2, 2)),
-            layers.Dropout(0.25),
-            
-            layers.Flatten(),
-            layers.Dense(512, activation='relu'),
-            layers.BatchNormalization(),
-            layers.Dropout(0.5),
-            layers.Dense(256, activation='relu'),
-            layers.Dropout(0.5),
-            layers.Dense(len(self.mood_classes), activation='softmax')
-        ])
+        """Build the CNN: one conv block per entry in filters, then the dense head
+
+        The default blocks are two valid 3x3 convs each, flattened into the head.
+        Separable architectures use a single same-padded depthwise-separable conv
+        per block (plain conv for the first) and global average pooling instead.
+        """
+        dropout = self.architecture['dropout']
+        model_layers = [layers.Input(shape=self.input_shape)]
+        
+        if self.architecture['separable']:
+            for i, filters in enumerate(self.architecture['filters']):
+                conv = layers.Conv2D if i == 0 else layers.SeparableConv2D
+                model_layers += [
+                    conv(filters, (3, 3), padding='same', activation='relu'),
+                    layers.BatchNormalization(),
+                    layers.MaxPooling2D((2, 2)),
+                ]
+            model_layers.append(layers.GlobalAveragePooling2D())
+        else:
+            for filters in self.architecture['filters']:
+                model_layers += [
+                    layers.Conv2D(filters, (3, 3), activation='relu'),
+                    layers.BatchNormalization(),
+                    layers.Conv2D(filters, (3, 3), activation='relu'),
+                    layers.MaxPooling2D((2, 2)),
+                    layers.Dropout(dropout / 2),
+                ]
+            model_layers.append(layers.Flatten())
+        
+        for i, units in enumerate(self.architecture['dense_units']):
+            model_layers.append(layers.Dense(units, activation='relu'))
+            if i == 0:
+                model_layers.append(layers.BatchNormalization())
+            model_layers.append(layers.Dropout(dropout))
+        model_layers.append(layers.Dense(len(self.mood_classes), activation='softmax'))
+        
+        model = keras.Sequential(model_layers)
         
         model.compile(
             optimizer='adam',
@@ -60,13 +132,16 @@ class SketchMoodCNN:
         return model
     
     def _load_or_create_model(self):
-        """Load existing model or create new one"""
+        """Load existing model or create new one; self.loaded records which happened"""
+        self.loaded = False
         try:
-            if os.path.exists(self.model_path) and os.path.exists(self.label_encoder_path):
+            if self.load_existing and os.path.exists(self.model_path) and os.path.exists(self.label_encoder_path):
                 print("Loading existing model...")
                 self.model = keras.models.load_model(self.model_path)
+                self.input_shape = tuple(self.model.input_shape[1:])
                 with open(self.label_encoder_path, 'rb') as f:
                     self.label_encoder = pickle.load(f)
+                self.loaded = True
                 print("Model loaded successfully!")
             else:
                 print("Creating new model...")
@@ -93,10 +168,12 @@ class SketchMoodCNN:
                 background = Image.new('RGBA', image.size, (255, 255, 255, 255))
                 image = Image.alpha_composite(background, image).convert('RGB')
             
-            image = ImageOps.fit(image, (64, 64)).convert('L')
+            image = ImageOps.fit(image, self.input_shape[1::-1]).convert('L')
             image_array = np.array(image)
         else:
             image_array = image
+            if image_array.shape[:2] != self.input_shape[:2]:
+                image_array = cv2.resize(image_array, self.input_shape[1::-1])
         
         image_array = image_array.astype('float32') / 255.0
         
@@ -109,7 +186,8 @@ class SketchMoodCNN:
         try:
             processed_image = self.preprocess_image(pil_img)
             
-            predictions = self.model.predict(processed_image, verbose=0)
+            # predict_on_batch skips predict()'s per-call loop setup, which dominates for one image
+            predictions = self.model.predict_on_batch(processed_image)
             predicted_class_idx = np.argmax(predictions[0])
             confidence = float(predictions[0][predicted_class_idx])
             
@@ -121,6 +199,28 @@ class SketchMoodCNN:
             print(f"Prediction error: {e}")
             return self._dummy_prediction(pil_img)
     
+    def predict_batch(self, pil_imgs, batch_size=64):
+        """Predict moods for many images with one forward pass per batch; errors propagate"""
+        processed_images = np.concatenate([self.preprocess_image(img) for img in pil_imgs])
+
+        predictions = np.concatenate([
+            self.model.predict_on_batch(processed_images[start:start + batch_size])
+            for start in range(0, len(processed_images), batch_size)
+        ])
+        predicted_class_idxs = np.argmax(predictions, axis=1)
+
+        return [
+            (self.mood_classes[idx], float(predictions[i][idx]))
+            for i, idx in enumerate(predicted_class_idxs)
+        ]
+
+    def predict_batch_from_pil(self, pil_imgs, batch_size=64):
+        try:
+            return self.predict_batch(pil_imgs, batch_size=batch_size)
+        except Exception as e:
+            print(f"Batch prediction error: {e}")
+            return [self._dummy_prediction(img) for img in pil_imgs]
+
     def _dummy_prediction(self, pil_img):
         """Fallback dummy prediction if model fails"""
         import random
@@ -139,22 +239,28 @@ class SketchMoodCNN:
         
         return mood, min(max(conf, 0.0), 0.99)
     
-    def train_model(self, X_train, y_train, X_val=None, y_val=None, epochs=50, batch_size=32):
-        print(f"Training model with {len(X_train)} samples...")
-        
-        y_train_encoded = keras.utils.to_categorical(
-            self.label_encoder.transform(y_train), 
-            num_classes=len(self.mood_classes)
-        )
-        
-        if X_val is not None and y_val is not None:
-            y_val_encoded = keras.utils.to_categorical(
-                self.label_encoder.transform(y_val),
+    def train_model(self, X_train, y_train, X_val=None, y_val=None, epochs=50, batch_size=32, verbose=1):
+        """Train on in-memory arrays, or on ShardBatches (X_train/X_val) with y_train/y_val unused"""
+        if isinstance(X_train, ShardBatches):
+            print(f"Training model with {len(X_train.indices)} samples streamed from shards...")
+            fit_data = {'x': X_train, 'validation_data': X_val}
+        else:
+            print(f"Training model with {len(X_train)} samples...")
+            
+            y_train_encoded = keras.utils.to_categorical(
+                self.label_encoder.transform(y_train), 
                 num_classes=len(self.mood_classes)
             )
-            validation_data = (X_val, y_val_encoded)
-        else:
-            validation_data = None
+            
+            if X_val is not None and y_val is not None:
+                y_val_encoded = keras.utils.to_categorical(
+                    self.label_encoder.transform(y_val),
+                    num_classes=len(self.mood_classes)
+                )
+                validation_data = (X_val, y_val_encoded)
+            else:
+                validation_data = None
+            fit_data = {'x': X_train, 'y': y_train_encoded, 'batch_size': batch_size, 'validation_data': validation_data}
         
         callbacks = [
             keras.callbacks.EarlyStopping(patience=10, restore_best_weights=True),
@@ -163,12 +269,10 @@ class SketchMoodCNN:
         ]
         
         history = self.model.fit(
-            X_train, y_train_encoded,
+            **fit_data,
             epochs=epochs,
-            batch_size=batch_size,
-            validation_data=validation_data,
             callbacks=callbacks,
-            verbose=1
+            verbose=verbose
         )
         
 
@@ -179,28 +283,44 @@ class SketchMoodCNN:
         print("Model training completed and saved!")
         return history
     
+    def measure_latency(self, runs=50, warmup=5):
+        """Median single-image latency in milliseconds, timed the way serving calls the model"""
+        sample = np.zeros((1,) + tuple(self.input_shape), dtype='float32')
+        for _ in range(warmup):
+            self.model.predict_on_batch(sample)
+        
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            self.model.predict_on_batch(sample)
+            timings.append(time.perf_counter() - started)
+        
+        return float(np.median(timings) * 1000)
+    
     def load_dataset_from_folder(self, dataset_path):
         """Load dataset from organized folder structure"""
         images = []
         labels = []
         
+        manifest = refresh_manifest(dataset_path)
+        
         for mood in self.mood_classes:
             mood_path = os.path.join(dataset_path, mood)
-            if os.path.exists(mood_path):
-                for filename in os.listdir(mood_path):
-                    if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                        img_path = os.path.join(mood_path, filename)
-                        try:
+            mood_files = manifest['moods'].get(mood, {}).get('files', {})
+            if mood_files:
+                for filename in sorted(mood_files):
+                    img_path = os.path.join(mood_path, filename)
+                    try:
 
-                            img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-                            img = cv2.resize(img, (64, 64))
-                            img = img.astype('float32') / 255.0
-                            img = np.expand_dims(img, axis=-1)
-                            
-                            images.append(img)
-                            labels.append(mood)
-                        except Exception as e:
-                            print(f"Error loading {img_path}: {e}")
+                        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+                        img = cv2.resize(img, self.input_shape[1::-1])
+                        img = img.astype('float32') / 255.0
+                        img = np.expand_dims(img, axis=-1)
+                        
+                        images.append(img)
+                        labels.append(mood)
+                    except Exception as e:
+                        print(f"Error loading {img_path}: {e}")
         
         if len(images) == 0:
             print("No images found in dataset!")
@@ -208,6 +328,39 @@ class SketchMoodCNN:
         
         return np.array(images), np.array(labels)
     
+    def open_shards(self, shards_path):
+        """Memory-map packed images_*.npy shards (uint8) and load their labels
+
+        Returns (shards, offsets, labels) where offsets[i] is the global index of
+        shard i's first sample, or (None, None, None) if there are no shards.
+        """
+        image_files = sorted(glob.glob(os.path.join(shards_path, 'images_*.npy')))
+        if not image_files:
+            print("No shards found in dataset!")
+            return None, None, None
+        
+        shards = []
+        labels = []
+        for image_file in image_files:
+            directory, basename = os.path.split(image_file)
+            label_file = os.path.join(directory, 'labels_' + basename[len('images_'):])
+            shards.append(np.load(image_file, mmap_mode='r'))
+            labels.append(np.load(label_file))
+        
+        offsets = np.cumsum([0] + [len(shard) for shard in shards[:-1]])
+        return shards, offsets, np.concatenate(labels)
+    
+    def load_dataset_from_shards(self, shards_path):
+        """Load every shard into one float32 array (fine for sweeps/distillation on moderate datasets;
+        use open_shards with ShardBatches to train on large ones)"""
+        shards, offsets, labels = self.open_shards(shards_path)
+        if shards is None:
+            return None, None
+        
+        batches = ShardBatches(shards, offsets, np.arange(len(labels)), labels, len(labels), self.input_shape)
+        images, _ = batches[0]
+        return images, labels
+    
     def augment_data(self, images, labels, augment_factor=3):
         """Apply data augmentation to increase dataset size"""
         augmented_images = []
@@ -268,8 +421,11 @@ class SketchMoodCNN:
 sketch_model = None
 
 def get_model():
-    """Get or create the global model instance"""
+    """Get or create the global model instance
+
+    Set SKETCH_MODEL_PATH (e.g. ml/sketch_mood_student.h5) to serve a different model file.
+    """
     global sketch_model
     if sketch_model is None:
-        sketch_model = SketchMoodCNN()
+        sketch_model = SketchMoodCNN(model_path=os.environ.get('SKETCH_MODEL_PATH', 'ml/sketch_mood_model.h5'))
     return sketch_model
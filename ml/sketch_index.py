@@ -0,0 +1,161 @@
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+RECORD_DTYPE = np.dtype([('history_id', '<u8'), ('hash', '<u8')])
+BANDS = 4
+BAND_BITS = 16
+
+
+def sketch_hash(image):
+    """64-bit difference hash of a preprocessed grayscale sketch
+
+    Each bit says whether a pixel of the 9x8 thumbnail is brighter than its
+    left neighbour, so small strokes, noise and re-encoding barely move it.
+    """
+    small = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+class SketchIndex:
+    """Append-only near-duplicate index over sketch hashes
+
+    Records are 16-byte (history_id, hash) pairs in a flat file that every
+    worker process appends to, and each worker pulls in new records before
+    a query. Lookups split the hash into BANDS 16-bit bands and binary-search a
+    sorted table per band (any hash within BANDS - 1 bits shares a band
+    exactly), plus a linear scan of the records added since the last rebuild.
+    """
+
+    def __init__(self, path, merge_threshold=4096):
+        self.path = path
+        self.merge_threshold = merge_threshold
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.ids = np.empty(1024, dtype=np.uint64)
+        self.hashes = np.empty(1024, dtype=np.uint64)
+        self.size = 0
+        self._offset = 0
+        self._inode = None
+        self._indexed = 0
+        self._band_keys = [np.empty(0, dtype=np.uint16) for _ in range(BANDS)]
+        self._band_positions = [np.empty(0, dtype=np.intp) for _ in range(BANDS)]
+
+    def __len__(self):
+        self.sync()
+        return self.size
+
+    def add(self, history_id, hash_value):
+        append_records(self.path, [(history_id, hash_value)])
+        self.sync()
+
+    def sync(self):
+        """Load records appended since the last call, by this or any other process"""
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return
+            if self._inode is not None and stat.st_ino != self._inode:
+                self._reset()
+            self._inode = stat.st_ino
+
+            usable = stat.st_size - stat.st_size % RECORD_DTYPE.itemsize
+            if usable <= self._offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                records = np.frombuffer(f.read(usable - self._offset), dtype=RECORD_DTYPE)
+            self._offset = usable
+            self._append(records)
+
+            if self.size - self._indexed > self.merge_threshold:
+                self._rebuild()
+
+    def _append(self, records):
+        needed = self.size + len(records)
+        if needed > len(self.ids):
+            capacity = max(needed, len(self.ids) * 2)
+            self.ids = np.resize(self.ids, capacity)
+            self.hashes = np.resize(self.hashes, capacity)
+        self.ids[self.size:needed] = records['history_id']
+        self.hashes[self.size:needed] = records['hash']
+        self.size = needed
+
+    def _rebuild(self):
+        hashes = self.hashes[:self.size]
+        for band in range(BANDS):
+            keys = ((hashes >> np.uint64(band * BAND_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(keys, kind='stable')
+            self._band_keys[band] = keys[order]
+            self._band_positions[band] = order
+        self._indexed = self.size
+
+    def hash_for(self, history_id):
+        self.sync()
+        matches = np.flatnonzero(self.ids[:self.size] == np.uint64(history_id))
+        return int(self.hashes[matches[-1]]) if len(matches) else None
+
+    def query(self, hash_value, k=10, max_distance=10, exclude_id=None):
+        """Up to k (history_id, hamming distance) pairs, closest first"""
+        self.sync()
+        hash_value = np.uint64(hash_value)
+        candidates = [np.arange(self._indexed, self.size)]
+        for band in range(BANDS):
+            key = np.uint16((hash_value >> np.uint64(band * BAND_BITS)) & np.uint64(0xFFFF))
+            keys = self._band_keys[band]
+            lo, hi = np.searchsorted(keys, key, 'left'), np.searchsorted(keys, key, 'right')
+            candidates.append(self._band_positions[band][lo:hi])
+
+        positions = np.unique(np.concatenate(candidates))
+        distances = np.bitwise_count(self.hashes[positions] ^ hash_value)
+        keep = distances <= max_distance
+        if exclude_id is not None:
+            keep &= self.ids[positions] != np.uint64(exclude_id)
+        positions, distances = positions[keep], distances[keep]
+
+        best = np.argsort(distances, kind='stable')
+        results = []
+        seen = set()
+        for i in best:
+            history_id = int(self.ids[positions[i]])
+            if history_id in seen:
+                continue
+            seen.add(history_id)
+            results.append((history_id, int(distances[i])))
+            if len(results) == k:
+                break
+        return results
+
+
+def append_records(path, records):
+    """Append (history_id, hash) pairs with O_APPEND so concurrent writers never interleave a record"""
+    records = list(records)
+    if not records:
+        return 0
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        for record in records:
+            os.write(fd, np.array([record], dtype=RECORD_DTYPE).tobytes())
+    finally:
+        os.close(fd)
+    return len(records)
+
+
+def write_index(path, records):
+    """Atomically replace the index file with an iterable of (history_id, hash) pairs"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'wb') as f:
+        for history_id, hash_value in records:
+            f.write(np.array([(history_id, hash_value)], dtype=RECORD_DTYPE).tobytes())
+            count += 1
+    os.replace(tmp_path, path)
+    return count
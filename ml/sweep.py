@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import random
+import argparse
+import glob
+import hashlib
+import itertools
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_int_tuples(value):
+    """'32-64-128,16-32' -> [(32, 64, 128), (16, 32)]"""
+    return [tuple(int(n) for n in part.split('-')) for part in value.split(',') if part]
+
+
+def parse_list(value, cast):
+    return [cast(part) for part in value.split(',') if part]
+
+
+def final_feature_size(input_size, blocks):
+    """Spatial size after the conv blocks (each block: two valid 3x3 convs, then 2x2 pooling)"""
+    for _ in range(blocks):
+        input_size = (input_size - 4) // 2
+    return input_size
+
+
+def build_search_space(filters, dense_units, dropout, input_size, max_trials=None, seed=0):
+    """Grid over every combination, randomly subsampled to max_trials if given"""
+    trials = [
+        {'filters': f, 'dense_units': d, 'dropout': p, 'input_size': s}
+        for f, d, p, s in itertools.product(filters, dense_units, dropout, input_size)
+        if final_feature_size(s, len(f)) >= 1
+    ]
+    if max_trials and len(trials) > max_trials:
+        trials = random.Random(seed).sample(trials, max_trials)
+    return trials
+
+
+def dataset_fingerprint(dataset_path, test_size):
+    """Identify the dataset contents: shard files, or the manifest's per-file entries"""
+    from ml.dataset_manifest import refresh_manifest
+
+    shard_files = sorted(glob.glob(os.path.join(dataset_path, '*_*.npy')))
+    if shard_files:
+        contents = [(os.path.basename(p), os.path.getsize(p), os.path.getmtime(p)) for p in shard_files]
+    else:
+        manifest = refresh_manifest(dataset_path)
+        contents = {mood: sorted((name, f['size'], f['mtime']) for name, f in info['files'].items())
+                    for mood, info in manifest['moods'].items()}
+    digest = hashlib.sha1(json.dumps(contents, sort_keys=True).encode()).hexdigest()
+    return {'dataset_path': os.path.abspath(dataset_path), 'test_size': test_size, 'contents_sha1': digest}
+
+
+def cache_dataset(dataset_path, cache_dir, test_size=0.2):
+    """Decode the dataset once at 64x64 and save the train/test split as .npy for the workers
+
+    The cache is reused only while source.json matches the dataset path, split and contents.
+    """
+    from sklearn.model_selection import train_test_split
+    from ml.sketch_cnn_model import SketchMoodCNN
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = {name: os.path.join(cache_dir, f'{name}.npy') for name in ('X_train', 'X_test', 'y_train', 'y_test')}
+    source_path = os.path.join(cache_dir, 'source.json')
+    fingerprint = dataset_fingerprint(dataset_path, test_size)
+    try:
+        with open(source_path) as f:
+            cached_fingerprint = json.load(f)
+    except (OSError, ValueError):
+        cached_fingerprint = None
+    if cached_fingerprint == fingerprint and all(os.path.exists(path) for path in cached.values()):
+        print(f"📦 Using cached dataset in {cache_dir}")
+        return cached
+    if os.path.exists(source_path):
+        os.remove(source_path)
+
+    print("📂 Decoding dataset once for all trials...")
+    loader = SketchMoodCNN(model_path=os.path.join(cache_dir, 'loader.h5'),
+                           label_encoder_path=os.path.join(cache_dir, 'loader.pkl'))
+    if glob.glob(os.path.join(dataset_path, 'images_*.npy')):
+        X, y = loader.load_dataset_from_shards(dataset_path)
+    else:
+        X, y = loader.load_dataset_from_folder(dataset_path)
+    if X is None:
+        return None
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=42, stratify=y)
+    for name, array in zip(('X_train', 'X_test', 'y_train', 'y_test'), (X_train, X_test, y_train, y_test)):
+        np.save(cached[name], array)
+    with open(source_path, 'w') as f:
+        json.dump(fingerprint, f)
+    print(f"✅ Cached {len(X_train)} train / {len(X_test)} test images")
+    return cached
+
+
+def _init_worker(threads):
+    """Pin BLAS, OpenCV and TensorFlow thread pools in this worker process
+
+    Spawn re-imports this module (and numpy with it) before the initializer
+    runs, so BLAS env vars are already too late; threadpoolctl resizes the
+    loaded pools instead. TensorFlow is only imported here, so its vars apply.
+    """
+    import cv2
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=threads)
+    cv2.setNumThreads(threads)
+    for var in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+        os.environ[var] = str(threads)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def run_trial(task):
+    """Worker: train one candidate on the cached split and measure accuracy, latency and size"""
+    trial_id, architecture, cached, output_dir, epochs, batch_size = task
+    from ml.preprocessing import resize_batch
+    from ml.sketch_cnn_model import SketchMoodCNN
+
+    trial_dir = os.path.join(output_dir, f'trial_{trial_id:03d}')
+    os.makedirs(trial_dir, exist_ok=True)
+    model = SketchMoodCNN(
+        model_path=os.path.join(trial_dir, 'model.h5'),
+        label_encoder_path=os.path.join(trial_dir, 'label_encoder.pkl'),
+        architecture=architecture
+    )
+
+    size = architecture['input_size']
+    X_train = resize_batch(np.load(cached['X_train'], mmap_mode='r'), size)
+    X_test = resize_batch(np.load(cached['X_test'], mmap_mode='r'), size)
+    y_train = np.load(cached['y_train'])
+    y_test = np.load(cached['y_test'])
+
+    model.train_model(X_train, y_train, X_test, y_test, epochs=epochs, batch_size=batch_size, verbose=0)
+    _, accuracy = model.model.evaluate(
+        X_test, np.eye(len(model.mood_classes))[model.label_encoder.transform(y_test)], verbose=0
+    )
+
+    result = {
+        'trial': trial_id,
+        'architecture': {k: list(v) if isinstance(v, tuple) else v for k, v in architecture.items()},
+        'accuracy': float(accuracy),
+        'latency_ms': model.measure_latency(),
+        'params': int(model.model.count_params()),
+        'model_path': model.model_path
+    }
+    print(f"  ✅ Trial {trial_id}: acc={result['accuracy']:.4f} latency={result['latency_ms']:.2f}ms params={result['params']}")
+    return result
+
+
+def pareto_front(results):
+    """Trials not beaten on every axis (higher accuracy, lower latency, fewer params) by another trial"""
+    def dominates(a, b):
+        no_worse = a['accuracy'] >= b['accuracy'] and a['latency_ms'] <= b['latency_ms'] and a['params'] <= b['params']
+        better = a['accuracy'] > b['accuracy'] or a['latency_ms'] < b['latency_ms'] or a['params'] < b['params']
+        return no_worse and better
+
+    return [r for r in results if not any(dominates(other, r) for other in results)]
+
+
+def run_sweep(dataset_path, trials, output_dir='ml/sweep', epochs=20, batch_size=32, workers=None, threads_per_worker=1):
+    workers = workers or max(1, os.cpu_count() // threads_per_worker)
+
+    print("🔍 Starting architecture sweep...")
+    print(f"Trials: {len(trials)}")
+    print(f"Workers: {workers} x {threads_per_worker} thread(s)")
+    print(f"Epochs per trial: {epochs}")
+    print("-" * 50)
+
+    cached = cache_dataset(dataset_path, os.path.join(output_dir, 'cache'))
+    if cached is None:
+        print("❌ No data found! Please check your dataset structure.")
+        return None
+
+    # A fresh directory per run, so trials never pick up model files from an earlier search space
+    run_dir = os.path.join(output_dir, 'run_' + datetime.now().strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(run_dir)
+    print(f"Run directory: {run_dir}")
+
+    tasks = [(i, trial, cached, run_dir, epochs, batch_size) for i, trial in enumerate(trials)]
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=workers, initializer=_init_worker, initargs=(threads_per_worker,), maxtasksperchild=1) as pool:
+        results = list(pool.imap_unordered(run_trial, tasks))
+
+    results.sort(key=lambda r: r['trial'])
+    front = {r['trial'] for r in pareto_front(results)}
+    for r in results:
+        r['pareto'] = r['trial'] in front
+
+    report_path = os.path.join(run_dir, 'results.json')
+    with open(report_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print("\n" + "="*50)
+    print("📊 SWEEP RESULTS (* = Pareto-optimal)")
+    print("="*50)
+    for r in sorted(results, key=lambda r: -r['accuracy']):
+        arch = r['architecture']
+        print(f"{'*' if r['pareto'] else ' '} trial {r['trial']:>3}  acc={r['accuracy']:.4f}  "
+              f"latency={r['latency_ms']:7.2f}ms  params={r['params']:>9}  "
+              f"filters={arch['filters']} dense={arch['dense_units']} dropout={arch['dropout']} input={arch['input_size']}")
+    print(f"\nFull report: {report_path}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel architecture sweep for SketchMoodCNN")
+    parser.add_argument("--dataset_path", type=str, required=True, help="Path to dataset folder or .npy shards")
+    parser.add_argument("--filters", type=str, default="32-64-128,16-32-64,8-16-32", help="Comma-separated filters per block, blocks joined by '-'")
+    parser.add_argument("--dense", type=str, default="512-256,128,64", help="Comma-separated dense widths, layers joined by '-'")
+    parser.add_argument("--dropout", type=str, default="0.5,0.3", help="Comma-separated dropout rates")
+    parser.add_argument("--input_size", type=str, default="64,48,32", help="Comma-separated input resolutions")
+    parser.add_argument("--max_trials", type=int, default=None, help="Randomly sample this many combinations")
+    parser.add_argument("--epochs", type=int, default=20, help="Training epochs per trial")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size for training")
+    parser.add_argument("--workers", type=int, default=None, help="Parallel trials (default: cores / threads_per_worker)")
+    parser.add_argument("--threads_per_worker", type=int, default=1, help="TensorFlow/BLAS threads per trial")
+    parser.add_argument("--output_dir", type=str, default="ml/sweep", help="Where trial models and results.json go")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for --max_trials sampling")
+
+    args = parser.parse_args()
+
+    trials = build_search_space(
+        parse_int_tuples(args.filters),
+        parse_int_tuples(args.dense),
+        parse_list(args.dropout, float),
+        parse_list(args.input_size, int),
+        max_trials=args.max_trials,
+        seed=args.seed
+    )
+    run_sweep(
+        args.dataset_path,
+        trials,
+        output_dir=args.output_dir,
+        epochs=args.epochs,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker
+    )
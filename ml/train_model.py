@@ -2,13 +2,19 @@
 
 import os
 import sys
+import glob
+import json
+import pickle
 import argparse
 from sklearn.model_selection import train_test_split
 import numpy as np
+import tensorflow as tf
+from tensorflow import keras
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from ml.sketch_cnn_model import SketchMoodCNN
+from ml.preprocessing import resize_batch
+from ml.sketch_cnn_model import SketchMoodCNN, ShardBatches, STUDENT_ARCHITECTURE
 
 def train_model(dataset_path, epochs=50, batch_size=32, test_size=0.2, augment=True):
     
@@ -23,6 +29,8 @@ def train_model(dataset_path, epochs=50, batch_size=32, test_size=0.2, augment=T
     model = SketchMoodCNN()
     
     print("📂 Loading dataset...")
+    if glob.glob(os.path.join(dataset_path, 'images_*.npy')):
+        return train_model_from_shards(model, dataset_path, epochs, batch_size, test_size)
     X, y = model.load_dataset_from_folder(dataset_path)
     
     if X is None or len(X) == 0:
@@ -84,6 +92,193 @@ def train_model(dataset_path, epochs=50, batch_size=32, test_size=0.2, augment=T
     
     return model, history
 
+def train_model_from_shards(model, dataset_path, epochs, batch_size, test_size):
+    """Train from packed .npy shards, streaming uint8 batches from disk instead of loading them all"""
+    print("Using packed .npy shards (streamed from disk)")
+    shards, offsets, labels = model.open_shards(dataset_path)
+    if shards is None:
+        return None
+    
+    print(f"✅ Found {len(labels)} images in {len(shards)} shards")
+    print("Class distribution:")
+    unique, counts = np.unique(labels, return_counts=True)
+    for mood, count in zip(unique, counts):
+        print(f"  {mood}: {count} images")
+    
+    print(f"\n📊 Splitting dataset (test size: {test_size})...")
+    onehot = np.eye(len(model.mood_classes), dtype='float32')[model.label_encoder.transform(labels)]
+    train_idx, test_idx = train_test_split(
+        np.arange(len(labels)), test_size=test_size, random_state=42, stratify=labels
+    )
+    train_batches = ShardBatches(shards, offsets, train_idx, onehot, batch_size, model.input_shape, shuffle=True)
+    test_batches = ShardBatches(shards, offsets, test_idx, onehot, batch_size, model.input_shape)
+    
+    print(f"Training set: {len(train_idx)} images")
+    print(f"Test set: {len(test_idx)} images")
+    
+    print(f"\n🤖 Training model for {epochs} epochs...")
+    history = model.train_model(train_batches, None, test_batches, None, epochs=epochs, batch_size=batch_size)
+    
+    print("\n📈 Evaluating model...")
+    test_loss, test_accuracy = model.model.evaluate(test_batches, verbose=0)
+    print(f"Test Accuracy: {test_accuracy:.4f}")
+    print(f"Test Loss: {test_loss:.4f}")
+    
+    print("\n✅ Training completed successfully!")
+    print(f"Model saved to: {model.model_path}")
+    print(f"Label encoder saved to: {model.label_encoder_path}")
+    
+    return model, history
+
+def distillation_loss(num_classes, temperature, alpha):
+    """Blend hard-label cross-entropy with KL divergence to the teacher's temperature-softened outputs
+
+    y_true is [one-hot labels | softened teacher probabilities]. The student still
+    ends in softmax for serving, so its probabilities are softened via log(p) / T.
+    """
+    def loss(y_true, y_pred):
+        hard_targets = y_true[:, :num_classes]
+        soft_targets = y_true[:, num_classes:]
+        soft_pred = tf.nn.softmax(tf.math.log(y_pred + 1e-7) / temperature)
+        hard_loss = keras.losses.categorical_crossentropy(hard_targets, y_pred)
+        soft_loss = keras.losses.kld(soft_targets, soft_pred) * temperature ** 2
+        return alpha * hard_loss + (1 - alpha) * soft_loss
+    
+    def accuracy(y_true, y_pred):
+        return keras.metrics.categorical_accuracy(y_true[:, :num_classes], y_pred)
+    
+    return loss, accuracy
+
+def soften(probabilities, temperature):
+    logits = np.log(probabilities + 1e-7) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def distill_model(dataset_path, teacher_path='ml/sketch_mood_model.h5', student_path='ml/sketch_mood_student.h5',
+                  epochs=50, batch_size=32, test_size=0.2, temperature=4.0, alpha=0.3, input_size=32,
+                  report_path='ml/distill_report.json', resume=False,
+                  label_encoder_path='ml/label_encoder.pkl'):
+    
+    print("🧪 Starting knowledge distillation...")
+    print(f"Teacher: {teacher_path}")
+    print(f"Student: {student_path}")
+    print(f"Student input size: {input_size}x{input_size}")
+    print(f"Temperature: {temperature}")
+    print(f"Alpha (hard-label weight): {alpha}")
+    print("-" * 50)
+    
+    for path in (teacher_path, label_encoder_path):
+        if not os.path.exists(path):
+            print(f"❌ Teacher file not found: {path}")
+            print("Train it first: python ml/train_model.py --dataset_path " + dataset_path)
+            return None
+    
+    teacher = SketchMoodCNN(model_path=teacher_path, label_encoder_path=label_encoder_path)
+    if not teacher.loaded:
+        print(f"❌ Could not load the teacher from {teacher_path}; refusing to distill from an untrained network")
+        return None
+    
+    student = SketchMoodCNN(
+        model_path=student_path,
+        label_encoder_path=label_encoder_path,
+        architecture={**STUDENT_ARCHITECTURE, 'input_size': input_size},
+        load_existing=resume
+    )
+    if resume:
+        if not student.loaded:
+            print(f"❌ --resume given but no student could be loaded from {student_path}")
+            return None
+        if student.input_shape[0] != input_size:
+            print(f"❌ {student_path} takes {student.input_shape[0]}x{student.input_shape[0]} input, "
+                  f"not the requested {input_size}x{input_size}; drop --resume to train a new student")
+            return None
+        print(f"↪️  Resuming distillation from {student_path}")
+    elif os.path.exists(student_path):
+        print(f"⚠️  {student_path} will be replaced by a freshly initialised student (use --resume to continue it)")
+    
+    print("📂 Loading dataset...")
+    if glob.glob(os.path.join(dataset_path, 'images_*.npy')):
+        X, y = teacher.load_dataset_from_shards(dataset_path)
+    else:
+        X, y = teacher.load_dataset_from_folder(dataset_path)
+    if X is None or len(X) == 0:
+        print("❌ No data found! Please check your dataset structure.")
+        return None
+    print(f"✅ Loaded {len(X)} images")
+    
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=test_size, random_state=42, stratify=y
+    )
+    
+    num_classes = len(teacher.mood_classes)
+    print("\n🎓 Computing teacher soft targets...")
+    teacher_probs = teacher.model.predict(X_train, batch_size=256, verbose=0)
+    targets = np.concatenate([
+        np.eye(num_classes)[teacher.label_encoder.transform(y_train)],
+        soften(teacher_probs, temperature)
+    ], axis=1)
+    y_test_onehot = np.eye(num_classes)[teacher.label_encoder.transform(y_test)]
+    
+    X_train_student = resize_batch(X_train, student.input_shape[0])
+    X_test_student = resize_batch(X_test, student.input_shape[0])
+    
+    loss, accuracy = distillation_loss(num_classes, temperature, alpha)
+    student.model.compile(optimizer='adam', loss=loss, metrics=[accuracy])
+    
+    print(f"\n🤖 Training student for {epochs} epochs...")
+    history = student.model.fit(
+        X_train_student, targets,
+        epochs=epochs,
+        batch_size=batch_size,
+        validation_split=0.1,
+        callbacks=[
+            keras.callbacks.EarlyStopping(patience=10, restore_best_weights=True),
+            keras.callbacks.ReduceLROnPlateau(patience=5, factor=0.5)
+        ],
+        verbose=1
+    )
+    
+    # Recompile with the standard loss so the saved file loads without custom objects
+    student.model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+    os.makedirs(os.path.dirname(student_path) or '.', exist_ok=True)
+    student.model.save(student_path)
+    if not os.path.exists(student.label_encoder_path):
+        with open(student.label_encoder_path, 'wb') as f:
+            pickle.dump(student.label_encoder, f)
+    
+    print("\n📈 Comparing teacher and student...")
+    report = {}
+    for name, model, X_eval in (('teacher', teacher, X_test), ('student', student, X_test_student)):
+        _, test_accuracy = model.model.evaluate(X_eval, y_test_onehot, verbose=0)
+        params = int(model.model.count_params())
+        report[name] = {
+            'model_path': model.model_path,
+            'input_size': int(model.input_shape[0]),
+            'accuracy': float(test_accuracy),
+            'latency_ms': model.measure_latency(),
+            'params': params,
+            'weights_mb': sum(int(np.prod(w.shape)) * np.dtype(w.dtype).itemsize for w in model.model.weights) / 1e6,
+            'file_mb': os.path.getsize(model.model_path) / 1e6
+        }
+    
+    print(f"{'':<10}{'accuracy':>10}{'latency':>12}{'params':>12}{'weights':>10}{'file':>10}")
+    for name, row in report.items():
+        print(f"{name:<10}{row['accuracy']:>10.4f}{row['latency_ms']:>10.2f}ms{row['params']:>12}"
+              f"{row['weights_mb']:>8.2f}MB{row['file_mb']:>8.2f}MB")
+    print(f"Speedup: {report['teacher']['latency_ms'] / report['student']['latency_ms']:.1f}x, "
+          f"{report['teacher']['params'] / report['student']['params']:.1f}x fewer parameters")
+    
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    
+    print("\n✅ Distillation completed successfully!")
+    print(f"Student saved to: {student_path}")
+    print(f"Report saved to: {report_path}")
+    print(f"Serve it with: SKETCH_MODEL_PATH={student_path} python app.py")
+    
+    return student, history, report
+
 def create_sample_dataset(output_path):
     """Create a sample dataset structure with placeholder instructions"""
     
@@ -126,6 +321,13 @@ if __name__ == "__main__":
     parser.add_argument("--test_size", type=float, default=0.2, help="Test set proportion")
     parser.add_argument("--no_augment", action="store_true", help="Disable data augmentation")
     parser.add_argument("--create_sample", action="store_true", help="Create sample dataset structure")
+    parser.add_argument("--distill", action="store_true", help="Train a small student model from the existing teacher")
+    parser.add_argument("--teacher_path", type=str, default="ml/sketch_mood_model.h5", help="Teacher model for --distill")
+    parser.add_argument("--student_path", type=str, default="ml/sketch_mood_student.h5", help="Where to save the student model")
+    parser.add_argument("--student_input_size", type=int, default=32, help="Student input resolution")
+    parser.add_argument("--temperature", type=float, default=4.0, help="Distillation softmax temperature")
+    parser.add_argument("--alpha", type=float, default=0.3, help="Weight of the hard-label loss (rest goes to soft targets)")
+    parser.add_argument("--resume", action="store_true", help="Continue distilling the existing --student_path model")
     
     args = parser.parse_args()
     
@@ -137,6 +339,21 @@ if __name__ == "__main__":
             print("Use --create_sample to create the dataset structure first")
             sys.exit(1)
         
+        if args.distill:
+            distill_model(
+                args.dataset_path,
+                teacher_path=args.teacher_path,
+                student_path=args.student_path,
+                epochs=args.epochs,
+                batch_size=args.batch_size,
+                test_size=args.test_size,
+                temperature=args.temperature,
+                alpha=args.alpha,
+                input_size=args.student_input_size,
+                resume=args.resume
+            )
+            sys.exit(0)
+        
         train_model(
             args.dataset_path,
             epochs=args.epochs,